@@ -1,27 +1,26 @@
 #!/usr/bin/env python3
 
-import sys, os, tempfile
+import sys, os
 import re, base64, zlib, textwrap
 import socket, ssl
 from typing import Union
-from io import BytesIO
 from hashlib import sha256
-from pkg_resources import parse_version
+#from pkg_resources import parse_version     # moved below, since it is
+                                            # slow to import and only
+                                            # needed for weasyprint.
 #from weasyprint import HTML, CSS       # moved below to improve performance
                                         # if weasyprint is not used.
-from urllib.parse import urlparse, urljoin, quote as urlquote,\
-                                            unquote as urlunquote
+from urllib.parse import urlparse, urljoin, unquote as urlunquote
 from html import escape as html_escape
-from mimetypes import guess_extension
-from getopt import gnu_getopt as getopt
-from copy import deepcopy
 
 
 magic_line = '%♊\ufe0e🗎\ufe0e'
 
 
 def warn(msg: str):
-    print(textwrap.fill(msg), file=sys.stderr)
+    # A single write, since stderr is line buffered and print would
+    # flush the message and the final newline separately
+    sys.stderr.write(textwrap.fill(msg)+'\n')
 def err(msg: str):
     warn(msg); exit(1)
 
@@ -29,159 +28,213 @@ def err(msg: str):
 class GemdocClientException(Exception):
     pass
 
-def retrieve_url(url: str, max_redirects=5) -> \
-                                        tuple[str,str,Union[str,bytes]]:
+# Server certificates are not verified (gemini relies on TOFU, which
+# gemdoc does not implement), so there is no need to load the system's
+# CA certificates. The context is shared by all requests, and the last
+# session negotiated with each server is kept so that redirects and
+# further requests to the same capsule can resume it.
+_tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+_tls_context.check_hostname = False
+_tls_context.verify_mode = ssl.CERT_NONE
+_tls_sessions = dict()
+
+def retrieve_url(url: str, max_redirects=5, connect_timeout=10,
+                 read_timeout=30) -> tuple[str,str,str,bytes]:
     """
-    Returns a tuple of type (url, content), where url is possibly
-    different from the one supplied as an argument if there have been
-    any redirects.
+    Returns a tuple of type (url, mime_type, charset, content), where url
+    is possibly different from the one supplied as an argument if there
+    have been any redirects. The content is returned as is; it is up to
+    the caller to decode it using the charset if needed. The timeouts are
+    given in seconds; read_timeout applies to each individual read from
+    the server rather than the transfer as a whole.
     """
-    if max_redirects <= 0:
-        raise GemdocClientException('Maximum number of redirects exceeded')
-    url = url.replace('\r\n', '%0A').replace('\n', '%0A')
-    scheme, host, path, params, query, _fragment = urlparse(url); port = 1965
-    query = query.replace(' ', '%20')
-    url = f'{scheme}://{host}{path or "/"}'\
-          f'{";"+params if params else ""}{"?"+query if query else ""}'
-    content = list()
-    if scheme != 'gemini':
-        raise GemdocClientException(f'Unsupported url scheme {scheme}')
-    if ':' in host: host, port = host.rsplit(':', maxsplit=1)
-    context = ssl.create_default_context()
-    context.check_hostname = False
-    context.verify_mode = ssl.CERT_NONE
-    with socket.create_connection((host, int(port))) as sock:
-        with context.wrap_socket(sock, server_hostname=host) as ssock:
-            ssock.send(f'{url}\r\n'.encode('utf-8'))
-            response = ssock.recv(1029)
-            # I am not entirely sure why the loop below is needed, but in
-            # some cases I only get the status code on the first recv, so
-            # I need to call recv multiple times to fetch the whole status
-            # line.
-            while len(response) < 1029:
-                lastlen = len(response)
-                response += ssock.recv(1029-len(response))
-                if len(response) == lastlen: break
-            if b'\r\n' not in response:
-                raise GemdocClientException('Server response too long')
-            header, rest = response.split(b'\r\n', maxsplit=1)
-            header = header.decode('utf-8')
-            if not header[:2].isnumeric():
-                raise GemdocClientException('Invalid response from server')
-            if header.startswith('3'):
-                dest = header[3:]
-                destscheme, desthost, *_ = urlparse(dest)
-                if destscheme: pass
-                elif dest.startswith('//'): dest = f'gemini:{dest}'
-                elif dest.startswith('/'): dest = f'gemini://{host}{dest}'
-                else: dest = 'gemini:'+urljoin(f'//{host}{path}', dest)
-                warn(f"Following redirect to '{dest}'")
-                return retrieve_url(dest, max_redirects=max_redirects-1)
-            elif header.startswith('2'):
-                mime_type, *params = header[3:].split(';')
-                mime_type = mime_type.strip().lower()
-                charset = 'utf-8'
-                for p in params:
-                    k, *v = p.strip().split('=', maxsplit=1)
-                    k, v = k.strip().lower(), v[0].strip() if v else ''
-                    if k == 'charset': charset = v
-                doc = [rest]
-                while True:
-                    next = ssock.recv(1024)
-                    if not next: break
-                    doc.append(next)
-                doc = b''.join(doc)
-                if mime_type.startswith('text/'): doc = doc.decode(charset)
-                return url, mime_type, doc
-            else:
-                raise GemdocClientException(f"Server replied: '{header}'")
+    for _ in range(max_redirects):
+        url = url.replace('\r\n', '%0A').replace('\n', '%0A')
+        scheme, host, path, params, query, _fragment = urlparse(url)
+        port = 1965
+        query = query.replace(' ', '%20')
+        url = f'{scheme}://{host}{path or "/"}'\
+              f'{";"+params if params else ""}{"?"+query if query else ""}'
+        if scheme != 'gemini':
+            raise GemdocClientException(f'Unsupported url scheme {scheme}')
+        if ':' in host:
+            # Convert once, so that an explicit default port shares the
+            # session cache entry with an implicit one
+            host, port = host.rsplit(':', maxsplit=1); port = int(port)
+        with socket.create_connection((host, port),
+                                      timeout=connect_timeout) as sock:
+            sock.settimeout(read_timeout)
+            # The request is a single small write following the handshake;
+            # do not let Nagle's algorithm hold it back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with _tls_context.wrap_socket(
+                    sock, server_hostname=host,
+                    session=_tls_sessions.get((host, port))) as ssock:
+                ssock.sendall(f'{url}\r\n'.encode('utf-8'))
+                # The header may arrive in several records (some servers
+                # send the status code on its own), so keep reading until
+                # the end of the header line, but no further than the
+                # 1029 bytes a valid header line can take up.
+                response = ssock.recv(1029)
+                while b'\r\n' not in response and len(response) < 1029:
+                    received = ssock.recv(1029-len(response))
+                    if not received: break
+                    response += received
+                if ssock.session: _tls_sessions[(host, port)] = ssock.session
+                if b'\r\n' not in response:
+                    raise GemdocClientException('Server response too long')
+                header, rest = response.split(b'\r\n', maxsplit=1)
+                # bytes.isdigit only accepts ascii digits
+                if not header[:2].isdigit():
+                    raise GemdocClientException('Invalid response from server')
+                header = header.decode('utf-8')
+                if header.startswith('3'):
+                    dest = header[3:]
+                    destscheme, desthost, *_ = urlparse(dest)
+                    if destscheme: pass
+                    elif dest.startswith('//'): dest = f'gemini:{dest}'
+                    elif dest.startswith('/'): dest = f'gemini://{host}{dest}'
+                    else: dest = 'gemini:'+urljoin(f'//{host}{path}', dest)
+                    warn(f"Following redirect to '{dest}'")
+                    url = dest
+                elif header.startswith('2'):
+                    mime_type, *params = header[3:].split(';')
+                    mime_type = mime_type.strip().lower()
+                    charset = 'utf-8'
+                    for p in params:
+                        k, _, v = p.partition('=')
+                        k, v = k.strip().lower(), v.strip()
+                        if k == 'charset': charset = v
+                    doc = bytearray(rest); size = len(doc)
+                    while True:
+                        if len(doc) - size < 65536:
+                            doc.extend(bytes(max(len(doc), 65536)))
+                        received = ssock.recv_into(memoryview(doc)[size:])
+                        if not received: break
+                        size += received
+                    del doc[size:]
+                    return url, mime_type, charset, bytes(doc)
+                else:
+                    raise GemdocClientException(f"Server replied: '{header}'")
+    raise GemdocClientException('Maximum number of redirects exceeded')
 
 
+_pdf_keywords = frozenset((b'null', b'true', b'false'))
+_pdf_info_keys = {
+    'author': b'/Author', 'title': b'/Title', 'date': b'/PublishingDate',
+    'url': b'/URL', 'subject': b'/Subject', 'keywords': b'/Keywords',
+}
+_metadata_keys = {v: k for k, v in _pdf_info_keys.items()}
+_pdf_number_starts = frozenset(b'0123456789-')
+_pdf_non_whitespace_re = re.compile(rb'[^\s]')
+_pdf_line_end_re = re.compile(rb'[\r\n]')
+_pdf_name_end_re = re.compile(rb'[\s\(\)<>\[\]{}/%]')
+_pdf_string_special_re = re.compile(rb'[\\()]')
+_pdf_reference_re = re.compile(rb'\d+\s+\d+\s+R')
+_pdf_number_end_re = re.compile(rb'[^\d\.-]')
+_pdf_objnum_re = re.compile(rb'(\d+)\s+(\d+)\s+obj[\s]+')
+_pdf_obj_start_re = re.compile(rb'\d+\s+\d+\s+o')
+_pdf_obj_header_re = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+_pdf_xref_re = re.compile(rb'[\r\n]*xref')
+
 class GemdocPDFObject():
-    def _consume_whitespace(self, binary: bytes) -> bytes:
-        m = re.search(rb'[^\s]', binary)
-        if m: return binary[m.start():]
-        return binary
-    def _consume_objnum(self, binary: bytes) -> tuple[bytes,bytes]:
-        binary = self._consume_whitespace(binary)
-        m = re.match(rb'^(\d+)\s+(\d+)\s+obj[\s]+', binary)
+    # The _consume_* methods take the whole object and the position to
+    # start at, and return the position just after what they consumed.
+    # This way only the items themselves are ever copied out of the
+    # object, and not the rest of it, which may contain a large stream.
+    def _consume_whitespace(self, binary: bytes, pos=0) -> int:
+        m = _pdf_non_whitespace_re.search(binary, pos)
+        return m.start() if m else len(binary)
+    def _consume_objnum(self, binary: bytes, pos=0) -> tuple[int,bytes]:
+        pos = self._consume_whitespace(binary, pos)
+        m = _pdf_objnum_re.match(binary, pos)
         if not m:
-            raise Exception('No object at the start of '+str(binary[:10]))
+            raise Exception('No object at the start of '
+                            +str(binary[pos:pos+10]))
         objnum = '{} {} obj'.format(*[x.decode('ascii') for x in m.groups()])
-        return binary[m.end():], objnum.encode('ascii')
-    def _consume_list(self, binary: bytes, delim=(b'[',b']')) -> \
-                                                        tuple[bytes,dict]:
-        binary = self._consume_whitespace(binary)
-        if not binary.startswith(delim[0]):
+        return m.end(), objnum.encode('ascii')
+    def _consume_list(self, binary: bytes, pos=0, delim=(b'[',b']')) -> \
+                                                        tuple[int,list]:
+        pos = self._consume_whitespace(binary, pos)
+        if not binary.startswith(delim[0], pos):
             raise Exception('Expected '+str(delim[0])+' at the start of '\
-                            +str(binary[:10]))
-        binary = binary[len(delim[0]):]
+                            +str(binary[pos:pos+10]))
+        pos += len(delim[0])
         d = list()
+        close, close_byte = delim[1], delim[1][0]
         while True:
-            binary = self._consume_whitespace(binary)
-            if binary.startswith(b'%'):
+            pos = self._consume_whitespace(binary, pos)
+            # Dispatch on the first byte (an int) of the next item
+            first = binary[pos] if pos < len(binary) else None
+            if first == b'%'[0]:
                 # Strip all comments from within dictionaries
-                m = re.search(rb'[\r\n]', binary)
-                binary = b'' if not m else binary[m.start()+1:]
-            elif binary.startswith(b'/'):
-                end = re.search(rb'[\s\(\)<>\[\]{}/%]', binary[1:]).start()+1
-                key, binary = binary[:end], binary[end:]
-                d.append(key)
-            elif binary.startswith(b'('):
-                o, c = binary.find(b'(', 1), binary.find(b')', 1)
-                while 0 <= o < c:
-                    o, c = binary.find(b'(', c+1), binary.find(b')', c+1)
-                end = c+1
-                key, binary = binary[:end], binary[end:]
-                d.append(key)
-            elif binary.startswith(b'['):
-                binary, l = self._consume_list(binary)
+                m = _pdf_line_end_re.search(binary, pos)
+                pos = len(binary) if not m else m.start()+1
+            elif first == b'/'[0]:
+                end = _pdf_name_end_re.search(binary, pos+1).start()
+                d.append(binary[pos:end]); pos = end
+            elif first == b'('[0]:
+                # Balanced parentheses may occur unescaped within strings
+                depth, end = 1, pos+1
+                while depth:
+                    m = _pdf_string_special_re.search(binary, end)
+                    if not m:
+                        raise Exception('Unterminated string at '
+                                        +str(binary[pos:pos+10]))
+                    end = m.end(); c = binary[m.start()]
+                    if c == b'\\'[0]: end += 1
+                    elif c == b'('[0]: depth += 1
+                    else: depth -= 1
+                d.append(binary[pos:end]); pos = end
+            elif first == b'['[0]:
+                pos, l = self._consume_list(binary, pos)
                 d.append(l)
-            elif binary.startswith(b'<<'):
-                binary, key = self._consume_dictionary(binary)
-                d.append(key)
-            elif binary.startswith(b'<'):
-                end = binary.index(b'>')+1
-                key, binary = binary[:end], binary[end:]
+            elif first == b'<'[0] and binary.startswith(b'<', pos+1):
+                pos, key = self._consume_dictionary(binary, pos)
                 d.append(key)
-            elif re.match(b'^\d+\s+\d+\s+R', binary):
-                end = binary.index(b'R')+1
-                key, binary = binary[:end], binary[end:]
-                d.append(key)
-            elif re.match(b'^[\d-]', binary):
-                end = re.search(rb'[^\d\.-]', binary).start()
-                key, binary = binary[:end], binary[end:]
-                d.append(key)
-            elif binary.startswith(b'null'):
-                d.append(b'null'); binary = binary[4:]
-            elif binary.startswith(b'true'):
-                d.append(b'true'); binary = binary[4:]
-            elif binary.startswith(b'false'):
-                d.append(b'false'); binary = binary[5:]
-            elif binary.startswith(delim[1]):
-                binary = binary[len(delim[1]):]
+            elif first == b'<'[0]:
+                end = binary.index(b'>', pos)+1
+                d.append(binary[pos:end]); pos = end
+            elif first in _pdf_number_starts:
+                if first != b'-'[0] and _pdf_reference_re.match(binary, pos):
+                    end = binary.index(b'R', pos)+1
+                else:
+                    end = _pdf_number_end_re.search(binary, pos).start()
+                d.append(binary[pos:end]); pos = end
+            elif first == b'n'[0] and binary.startswith(b'null', pos):
+                d.append(b'null'); pos += 4
+            elif first == b't'[0] and binary.startswith(b'true', pos):
+                d.append(b'true'); pos += 4
+            elif first == b'f'[0] and binary.startswith(b'false', pos):
+                d.append(b'false'); pos += 5
+            elif first == close_byte and binary.startswith(close, pos):
+                pos += len(close)
                 break
             else:
-                raise Exception('Unknown list item at '+str(binary[:10]))
-        return binary, d
-    def _consume_dictionary(self, binary: bytes) -> tuple[bytes,dict]:
-        binary, l = self._consume_list(binary, delim=(b'<<',b'>>'))
-        d = dict()
-        while l:
-            if len(l) < 2:
-                raise Exception(f'Non-matched last object in dictionary: {l}')
-            k, v = l.pop(0), l.pop(0); d[k] = v
-        return binary, d
+                raise Exception('Unknown list item at '
+                                +str(binary[pos:pos+10]))
+        return pos, d
+    def _consume_dictionary(self, binary: bytes, pos=0) -> tuple[int,dict]:
+        pos, l = self._consume_list(binary, pos, delim=(b'<<',b'>>'))
+        if len(l) % 2:
+            raise Exception('Non-matched last object in dictionary: '
+                           f'{l[-1:]}')
+        # Pair up keys and values in a single pass over the list
+        items = iter(l)
+        return pos, dict(zip(items, items))
     def _serialize_list(self, l: list, delim=(b'[',b']')) -> bytes:
-        for i in range(len(l)):
-            if type(l[i]) == dict:
-                l[i] = self._serialize_dictionary(l[i])
-            elif type(l[i]) == list:
-                l[i] = self._serialize_list(l[i])
-            elif re.match(b'^[\d-]', l[i]) \
-                 or l[i] in [b'null', b'true', b'false']:
-                l[i] = b' '+l[i]
-        result = b''.join(l)
+        items = list()
+        for item in l:
+            if isinstance(item, dict):
+                items.append(self._serialize_dictionary(item))
+            elif isinstance(item, list):
+                items.append(self._serialize_list(item))
+            elif (item and item[0] in _pdf_number_starts) \
+                 or item in _pdf_keywords:
+                items.extend((b' ', item))
+            else:
+                items.append(item)
+        result = b''.join(items)
         if delim[0] in [b'[', b'<<']: result = result.lstrip(b' ')
         if delim[1] in [b']', b'>>']: result = result.rstrip(b' ')
         return delim[0]+result+delim[1]
@@ -191,28 +244,57 @@ class GemdocPDFObject():
             v = self._serialize_list([v], delim=(b'',b''))
             items.extend([k, v])
         return b'<<'+b''.join(items)+b'>>'
-    def __init__(self, binary: bytes):
-        binary, self._objnum = self._consume_objnum(binary)
-        if binary.startswith(b'<<'):
-            binary, self.dictionary = self._consume_dictionary(binary)
+    def __init__(self, binary: bytes, lazy=False):
+        """
+        If lazy is set, an object without a stream is only parsed once
+        one of its attributes is needed. Until then, serialize writes it
+        out as it was given.
+        """
+        if lazy and b'stream' not in binary:
+            self._lazy_binary = binary
+        else:
+            self._parse(binary)
+    def __getattr__(self, name):
+        # Only called for attributes that have not been set, which for
+        # lazy objects are all those that are set while parsing
+        binary = self.__dict__.pop('_lazy_binary', None)
+        if binary == None:
+            raise AttributeError(f"'{type(self).__name__}' object has no "
+                                 f"attribute '{name}'")
+        self._parse(binary)
+        return getattr(self, name)
+    def _parse(self, binary: bytes):
+        pos, self._objnum = self._consume_objnum(binary)
+        if binary.startswith(b'<<', pos):
+            pos, self.dictionary = self._consume_dictionary(binary, pos)
         else:
             self.dictionary = dict()
-        binary = self._consume_whitespace(binary)
-        if binary.startswith(b'stream\n'):
-            endstream = binary.find(b'endstream')
+        pos = self._consume_whitespace(binary, pos)
+        if binary.startswith(b'stream\n', pos):
+            endstream = binary.find(b'endstream', pos)
             if endstream == -1: raise Exception('Missing endstream keyword')
-            self._stream = binary[len(b'stream\n'):endstream]
+            self._stream = binary[pos+len(b'stream\n'):endstream]
             self._contents = None
         else:
-            endobj = binary.find(b'endobj')
+            endobj = binary.find(b'endobj', pos)
             if endobj == -1: raise Exception('Missing endobj keyword')
-            self._contents = binary[:endobj]
+            self._contents = binary[pos:endobj]
             self._stream = None
     def serialize(self, flateencode) -> bytes:
-        dictionary = deepcopy(self.dictionary)
-        flist = dictionary.pop(b'/Filter', [])
-        if type(flist) == bytes: flist = [flist]
-        if self._stream != None:
+        if '_lazy_binary' in self.__dict__:
+            return self._lazy_binary.rstrip().replace(b'\n', b'\r')+b'\r'
+        elif self._stream == None:
+            # Filters and lengths only apply to streams, so objects
+            # without one are written out with their dictionary as is
+            dictionary = self.dictionary
+            binary = self._contents.replace(b'\n', b'\r')
+        else:
+            # Serializing does not modify nested values, so a shallow copy
+            # is enough as long as the filter list is copied before it is
+            # changed
+            dictionary = dict(self.dictionary)
+            flist = dictionary.pop(b'/Filter', [])
+            flist = [flist] if isinstance(flist, bytes) else list(flist)
             stream = self._stream
             if flateencode: stream = zlib.compress(stream)
             stream = base64.a85encode(stream)+b'~>'     # TODO: breaks images
@@ -222,14 +304,11 @@ class GemdocPDFObject():
             binary = (b'\rstream\n' + stream + b'\rendstream\r')
             if flateencode: flist.insert(0, b'/FlateDecode')
             flist.insert(0, b'/ASCII85Decode')          # TODO: breaks images
-        else:
-            binary = self._contents.replace(b'\n', b'\r')
-        if flist:
             dictionary[b'/Filter'] = flist[0] if len(flist) == 1 else flist
-        if b'/Length' in dictionary:
-            dictionary[b'/Length'] = str(len(stream)).encode('ascii')
-        if b'/Length1' in dictionary:
-            _ = dictionary.pop(b'/Length1')
+            if b'/Length' in dictionary:
+                dictionary[b'/Length'] = str(len(stream)).encode('ascii')
+            if b'/Length1' in dictionary:
+                _ = dictionary.pop(b'/Length1')
         binary = self._objnum + b'\r' + \
                  (self._serialize_dictionary(dictionary)
                                             if dictionary else b'') + \
@@ -244,20 +323,73 @@ class GemdocPDFTrailer(GemdocPDFObject):
         return b'trailer\r'+self._serialize_dictionary(self.dictionary)+b'\r'
 
 class GemdocPDF():
-    def _discard_pre_obj(self, binary: bytes) -> tuple[bytes,bytes]:
-        m = re.search(rb'\d+\s+\d+\s+o', binary)
-        if not m: return b''
-        return binary[m.start():]
-    def _consume_obj(self, binary: bytes) -> tuple[int,bytes,bytes]:
-        m = re.match(rb'\s*(\d+)\s+(\d+)\s+obj', binary)
+    # Like the _consume_* methods of GemdocPDFObject, these take the
+    # position to start at, so that the rest of the file is never copied.
+    def _discard_pre_obj(self, binary: bytes, pos=0) -> int:
+        m = _pdf_obj_start_re.search(binary, pos)
+        return m.start() if m else len(binary)
+    def _consume_obj(self, binary: bytes, pos=0) -> tuple[int,int,bytes]:
+        m = _pdf_obj_header_re.match(binary, pos)
         main, sub = m.groups()
         if sub != b'0':
             raise Exception('Object revisions not implemented. '\
-                            'Unable to parse '+str(binary[:20]))
+                            'Unable to parse '+str(binary[pos:pos+20]))
         objnum = int(main.decode('ascii'))
-        endobj = binary.find(b'endobj')+len(b'endobj')
+        endobj = binary.find(b'endobj', pos)
         if endobj == -1: raise Exception('Missing endobj keyword')
-        return objnum, binary[:endobj]+b'\n', binary[endobj:]
+        endobj += len(b'endobj')
+        return endobj, objnum, binary[pos:endobj]+b'\n'
+    def _consume_xref(self, binary: bytes, info_only=False) -> bool:
+        """
+        Read all objects at the offsets listed in the cross-reference
+        table that startxref points to, and the trailer that follows it.
+        If info_only is set, only the document information dictionary is
+        read. This only handles files with a single classic xref table,
+        as produced by weasyprint and gemdoc. For anything else, False is
+        returned without reading any objects, and the caller has to scan
+        the whole file instead.
+        """
+        startxref = binary.rfind(b'startxref')
+        if startxref == -1: return False
+        try:
+            xref = int(binary[startxref+9:startxref+40].split()[0])
+        except (ValueError, IndexError):
+            return False
+        end = binary.find(b'trailer', xref)
+        if not binary.startswith(b'xref', xref) or not 0 <= end < startxref-1:
+            return False
+        trailer = binary[end+len(b'trailer'):startxref-1]
+        if b'/Prev' in trailer: return False
+        offsets = dict()
+        entries = binary[xref+len(b'xref'):end].split()
+        try:
+            i = 0
+            while i < len(entries):
+                first, count = int(entries[i]), int(entries[i+1]); i += 2
+                for objnum in range(first, first+count):
+                    offset, _gen, kind = entries[i:i+3]; i += 3
+                    if kind == b'n': offsets[objnum] = int(offset)
+        except (ValueError, IndexError):
+            return False
+        trailer = GemdocPDFTrailer(trailer)
+        if info_only:
+            info_ref = trailer.dictionary.get(b'/Info', b'')
+            info_objnum = int(info_ref.split()[0]) if info_ref else None
+            offsets = {k: v for k, v in offsets.items() if k == info_objnum}
+        objects = dict()
+        # Keep the objects in the order in which they appear in the file
+        for objnum, offset in sorted(offsets.items(), key=lambda x: x[1]):
+            m = _pdf_obj_header_re.match(binary, offset)
+            endobj = binary.find(b'endobj', offset)
+            if not m or int(m.group(1)) != objnum or m.group(2) != b'0' \
+                     or endobj == -1:
+                return False
+            endobj += len(b'endobj')
+            objects[objnum] = GemdocPDFObject(binary[offset:endobj]+b'\n',
+                                              lazy=True)
+        self._objects = objects
+        self._trailer = trailer
+        return True
     def _set_file_identifier(self):
         if self._gemini_hash == None:
             raise Exception('Unable to set primary ID for pdf document '
@@ -268,8 +400,14 @@ class GemdocPDF():
         pdf_id = f'[<{self._gemini_hash}><{self._binary_hash}>]'
         self._trailer.dictionary[b'/ID'] = pdf_id.encode('ascii')
     def __init__(self, gemini: str, binary: Union[bytes,str],
-                 gemini_filename='source.gmi', flateencode_streams=False):
-        if type(binary) == str: binary = binary.encode('utf-8')
+                 gemini_filename='source.gmi', flateencode_streams=False,
+                 info_only=False):
+        """
+        Set info_only to only load what get_metadata needs from files
+        that have a usable cross-reference table. Such an instance cannot
+        be serialized.
+        """
+        if isinstance(binary, str): binary = binary.encode('utf-8')
         self._gemini_hash = sha256(gemini.encode('utf-8')).hexdigest() \
                                                 if gemini != None else None
         self._binary_hash = sha256(binary).hexdigest() \
@@ -278,25 +416,27 @@ class GemdocPDF():
         self._gemini = gemini
         self._objects = dict()
         self._trailer = GemdocPDFTrailer(b'')
-        while binary:
-            if re.match(rb'[\r\n]*xref', binary):
-                s, e = binary.find(b'trailer'), binary.find(b'startxref')
+        binary = binary or b''
+        pos = len(binary) if self._consume_xref(binary, info_only) else 0
+        while pos < len(binary):
+            if _pdf_xref_re.match(binary, pos):
+                s = binary.find(b'trailer', pos)
+                e = binary.find(b'startxref', pos)
                 if 0 <= s < e-1:
                     s += len(b'trailer')
                     self._trailer = GemdocPDFTrailer(binary[s:e-1])
-                eof = binary.find(b'%%EOF')
-                binary = binary[eof+len(b'%%EOF'):] if eof > -1 else b''
+                eof = binary.find(b'%%EOF', pos)
+                pos = eof+len(b'%%EOF') if eof > -1 else len(binary)
             else:
-                binary = self._discard_pre_obj(binary)
-                if not binary: break
-                objnum, obj, binary = self._consume_obj(binary)
-                self._objects[objnum] = GemdocPDFObject(obj)
+                pos = self._discard_pre_obj(binary, pos)
+                if pos == len(binary): break
+                pos, objnum, obj = self._consume_obj(binary, pos)
+                self._objects[objnum] = GemdocPDFObject(obj, lazy=True)
         if gemini != None:
             self._gemini_objnum = max(self._objects.keys())+1
             self._make_attachment(self._gemini_objnum, gemini_filename)
     def _make_utf16_string(self, s: str) -> str:
-        return '<feff'+''.join(('{:02x}'.format(b)
-                                for b in s.encode('utf-16be')))+'>'
+        return '<feff'+s.encode('utf-16be').hex()+'>'
     def _make_attachment(self, gemini_objnum, gemini_filename):
         root_ref = self._trailer.dictionary.get(b'/Root')
         root_objnum = int(root_ref.decode('ascii').split()[0])
@@ -330,23 +470,13 @@ class GemdocPDF():
         for k in list(info.keys()):
             if info[k] == b'()': info.pop(k)
         for k, v in metadata.items():
-            if   k == 'author':    k = b'/Author'
-            elif k == 'title':     k = b'/Title'
-            elif k == 'date':      k = b'/PublishingDate'
-            elif k == 'url':       k = b'/URL'
-            elif k == 'subject':   k = b'/Subject'
-            elif k == 'keywords':  k = b'/Keywords'
-            info[k] = self._make_utf16_string(v).encode('ascii')
+            info[_pdf_info_keys.get(k, k)] = \
+                                self._make_utf16_string(v).encode('ascii')
     def get_metadata(self):
         metadata = dict()
         for k, v in self._info_dict().items():
-            if   k == b'/Author':          k = 'author'
-            elif k == b'/Title':           k = 'title'
-            elif k == b'/PublishingDate':  k = 'date'
-            elif k == b'/URL':             k = 'url'
-            elif k == b'/Subject':         k = 'subject'
-            elif k == b'/Keywords':        k = 'keywords'
-            else: continue
+            if k not in _metadata_keys: continue
+            k = _metadata_keys[k]
             if v.startswith(b'(') and v.endswith(b')'):
                 metadata[k] = v[1:-1].decode('ascii')
             elif v.startswith(b'<') and v.endswith(b'>'):
@@ -356,6 +486,15 @@ class GemdocPDF():
                 pass
         return metadata
     def serialize(self) -> bytes:
+        return bytes(self._serialize())
+    def serialize_into(self, f):
+        """
+        Write the serialized document to the binary file object f. Unlike
+        serialize, this does not make an immutable copy of the document
+        before writing it.
+        """
+        f.write(self._serialize())
+    def _serialize(self) -> bytearray:
         xref = dict()
         self._info_dict()[b'/Creator'] = b'(gemdoc)'
         p = self._info_dict().pop(b'/Producer')
@@ -370,31 +509,35 @@ class GemdocPDF():
             self._info_dict()[b'/Producer'] = p
         if self._gemini != None:
             self._set_file_identifier()
-            result = f'%PDF-1.7\n{magic_line}\n```\n```\r'.encode('utf-8')
+            result = bytearray(f'%PDF-1.7\n{magic_line}\n```\n```\r'
+                               .encode('utf-8'))
             xref[self._gemini_objnum] = len(result)
-            gemini_length = len(self._gemini.encode('utf-8'))
+            gemini = self._gemini.encode('utf-8')
             result += (f'{self._gemini_objnum} 0 obj\r'
                         '<</Type/EmbeddedFile/Subtype/text#2fgemini/Params'
-                            f'<</Size {gemini_length+1}>>'
-                         f'/Length {gemini_length+1}>>\rstream\n'
-                       f'{self._gemini}\n\nendstream\nendobj\n') \
-                                                            .encode('utf-8')
+                            f'<</Size {len(gemini)+1}>>'
+                         f'/Length {len(gemini)+1}>>\rstream\n') \
+                                                            .encode('ascii')
+            result += gemini
+            result += b'\n\nendstream\nendobj\n'
         else:
-            result = f'%PDF-1.7\n%¶🗎\ufe0e\n'.encode('utf-8')
+            result = bytearray(f'%PDF-1.7\n%¶🗎\ufe0e\n'.encode('utf-8'))
         result += b'```% What follows is a pdf representation of this file\n'
         for objnum, obj in self._objects.items():
             xref[objnum] = len(result)
             result += obj.serialize(flateencode=self._flateencode_streams)
         startxref = len(result); result += b'xref\r'
-        result += f'0 {max(xref.keys())+1}\r'.encode('ascii')
-        result += (10*'0'+' 65535 f \r').encode('ascii')
+        # The table is put together as a string and encoded only once
+        size = max(xref.keys())+1
+        table = [f'0 {size}\r', 10*'0'+' 65535 f \r']
         last_free = 0
-        for i in range(1, max(xref.keys())+1):
+        for i in range(1, size):
             if i in xref:
-                result += f'{xref[i]:010d} 00000 n \r'.encode('ascii')
+                table.append(f'{xref[i]:010d} 00000 n \r')
             else:
-                result += f'{last_free:010d} 00001 f \r'.encode('ascii')
+                table.append(f'{last_free:010d} 00001 f \r')
                 last_free = i
+        result += ''.join(table).encode('ascii')
         result += self._trailer.serialize()
         result += f'startxref\r{startxref}\r%%EOF\n'.encode('ascii')
         return result
@@ -403,15 +546,20 @@ class GemdocPDF():
 class GemdocParserException(Exception):
     pass
 
-def is_gemdoc_pdf(doc: str) -> bool:
+_pdf_header_re = re.compile(rb'\s*%PDF-')
+_magic_line_bytes = magic_line.encode('utf-8')
+
+def is_gemdoc_pdf(doc: bytes) -> bool:
     """
     Note that this function throws a GemdocParserException if it receives
     a pdf file that does not contain a valid gemdoc signature on the second
     line.
     """
-    if not doc.lstrip().startswith('%PDF-'):
-        False
-    elif not doc.lstrip().splitlines()[1].startswith(magic_line):
+    header = _pdf_header_re.match(doc)
+    if not header:
+        return False
+    elif not doc.startswith(_magic_line_bytes,
+                            doc.find(b'\n', header.end())+1 or len(doc)):
         raise GemdocParserException(
             'Received a pdf file but the gemdoc signature of '
            f"'{magic_line}' on the second line is missing."
@@ -419,29 +567,44 @@ def is_gemdoc_pdf(doc: str) -> bool:
     else:
         return True
 
-def extract_gemini_part(doc: str) -> tuple[str,dict]:
-    metadata = GemdocPDF(None, doc.encode('utf-8')).get_metadata()
-    start = doc.index('stream\n') + 7
-    end = doc.index('\nendstream\nendobj\n', start)
-    doc = doc[start:end]
+def extract_gemini_part(doc: bytes) -> tuple[str,dict]:
+    metadata = GemdocPDF(None, doc, info_only=True).get_metadata()
+    start = doc.index(b'stream\n') + 7
+    end = doc.index(b'\nendstream\nendobj\n', start)
+    doc = doc[start:end].decode('utf-8')
     # strip a single additional newline added in by gemdoc itself
     if doc.endswith('\n'): doc = doc[:-1]
     return doc, metadata
 
+_gemini_line_re = re.compile(r'```|###|##|#|>|\* |=>')
+_gemini_line_starts = frozenset('`#>*=')
+_c0_control_or_space = ''.join(chr(c) for c in range(0x21))
+_link_scheme_host_re = re.compile(r'(?:([A-Za-z][A-Za-z0-9+.-]*):)?'
+                                  r'(?://([^/?#]*))?')
+_non_ascii_re = re.compile(r'[^\x00-\x7f]')
+_filename_date_re = re.compile(
+    r'^([0-9]{4})([-/_])?([0-9]{2})\2([0-9]{2})([^0-9].*)$'
+)
+
+def link_scheme_and_host(link: str) -> tuple[str,str]:
+    """
+    Returns the same scheme and host that urlparse would extract from a
+    link, but without building a full ParseResult.
+    """
+    link = link.lstrip(_c0_control_or_space).replace('\t', '') \
+               .replace('\r', '').replace('\n', '')
+    scheme, host = _link_scheme_host_re.match(link).groups()
+    return (scheme or '').lower(), host or ''
+
 def parse_gemini(doc: str, metadata: dict) -> tuple[str,str]:
-    body = list(); got_title = False; preformatted = False
-    _, site_host, *_ = urlparse(metadata.get('url', ''))
-    def is_site_relative(link: str) -> bool:
-        _, link_host, *_ = urlparse(link)
-        return link_host == site_host
-    def add(line, tag='p', css_class=None) -> None:
-        if tag and css_class:
+    body = list(); got_title = False
+    _, site_host, site_path, *_ = urlparse(metadata.get('url', ''))
+    def add(line, tag, css_class=None) -> None:
+        if css_class:
             body.append(f'<{tag} class="{css_class}">'
-                        f'{html_escape(line)}</{tag}>')
-        elif tag:
-            body.append(f'<{tag}>{html_escape(line)}</{tag}>')
+                        f'{html_escape(line, quote=False)}</{tag}>')
         else:
-            body.append(html_escape(line))
+            body.append(f'<{tag}>{html_escape(line, quote=False)}</{tag}>')
     def add_empty_lines(i: int) -> int:
         """
         'i' is the index of the last, possibly non-empty line preceding
@@ -451,128 +614,154 @@ def parse_gemini(doc: str, metadata: dict) -> tuple[str,str]:
         no empty lines. Note that this function appends empty lines to
         the html body.
         """
-        i += 1
-        while i < len(doc) and not doc[i].strip():
-            body.append('<br />'); i += 1
+        start = i = i+1
+        while i < num_lines and not doc[i].strip(): i += 1
+        body.extend(['<br />'] * (i-start))
         return i-1
-    doc = doc.splitlines(); i = 0
-    while i < len(doc):
-        if preformatted and doc[i].startswith('```'):
-            body.append('</pre>'); preformatted = False
-            doc[i] = '```'
-        elif preformatted:
-            add(doc[i], tag=None)
-        elif doc[i].startswith('```'):
-            if i+1 < len(doc) and doc[i+1].startswith('```'):
-                i += 1
+    def add_paragraphs(i: int) -> int:
+        end = i+1
+        while end < num_lines and (line := doc[end]).strip() \
+                and not (line[:1] in _gemini_line_starts
+                         and _gemini_line_re.match(line)):
+            end += 1
+        if end == i+1:
+            add(doc[i], tag='p')
+        else:
+            # Escape the whole run at once; lines never contain '\n'
+            paragraphs = html_escape('\n'.join(doc[i:end]), quote=False)
+            body.append('<p>' + paragraphs.replace('\n', '</p>\n<p>')
+                        + '</p>')
+        return end-1
+    def add_preformatted(i: int) -> int:
+        if i+1 < num_lines and doc[i+1].startswith('```'):
+            return i+1
+        end = i+1
+        while end < num_lines and not doc[end].startswith('```'): end += 1
+        body.append('<pre>')
+        if end > i+1:
+            body.append(html_escape('\n'.join(doc[i+1:end]), quote=False))
+        if end < num_lines:
+            body.append('</pre>'); doc[end] = '```'
+        return end
+    def add_h3(i: int) -> int:
+        body.append('<div class="headingcontext">')
+        add(doc[i][3:].strip(), tag='h3')
+        i = add_empty_lines(i)
+        body.append('</div>')
+        return i
+    def add_h2(i: int) -> int:
+        body.append('<div class="headingcontext">')
+        add(doc[i][2:].strip(), tag='h2')
+        i = add_empty_lines(i)
+        body.append('</div>')
+        return i
+    def add_h1(i: int) -> int:
+        nonlocal got_title
+        body.append('<div class="headingcontext">')
+        if not got_title:
+            got_title = True; title = doc[i][1:].strip()
+            add(title, tag='h1', css_class='title')
+            i = add_empty_lines(i)
+            if i+1 < num_lines and doc[i+1].startswith('##') \
+                              and doc[i+1][2:3] != '#':
+                i += 1; subtitle = doc[i][2:].strip()
+                add(subtitle, tag='h2', css_class='subtitle')
             else:
-                body.append('<pre>'); preformatted = True
-        elif doc[i].startswith('###'):
-            body.append('<div class="headingcontext">')
-            add(doc[i][3:].strip(), tag='h3')
+                subtitle = None
+            if title and subtitle and title[-1] in '.,;:?!':
+                metadata['title'] = f'{title} {subtitle}'
+            elif title and subtitle:
+                metadata['title'] = f'{title}: {subtitle}'
+            elif title:
+                metadata['title'] = title
+            if not metadata['title'].isascii():
+                metadata['title'] = _non_ascii_re.sub('_', metadata['title'])
             i = add_empty_lines(i)
-            body.append('</div>')
-        elif doc[i].startswith('##'):
-            body.append('<div class="headingcontext">')
-            add(doc[i][2:].strip(), tag='h2')
+        else:
+            add(doc[i][2:], tag='h1')
             i = add_empty_lines(i)
-            body.append('</div>')
-        elif doc[i].startswith('#'):
-            body.append('<div class="headingcontext">')
-            if not got_title:
-                got_title = True; title = doc[i][1:].strip()
-                add(title, tag='h1', css_class='title')
-                i = add_empty_lines(i)
-                if i+1 < len(doc) and doc[i+1].startswith('##') \
-                                  and doc[i+1][2:3] != '#':
-                    i += 1; subtitle = doc[i][2:].strip()
-                    add(subtitle, tag='h2', css_class='subtitle')
-                else:
-                    subtitle = None
-                if title and subtitle and title[-1] in '.,;:?!':
-                    metadata['title'] = f'{title} {subtitle}'
-                elif title and subtitle:
-                    metadata['title'] = f'{title}: {subtitle}'
-                elif title:
-                    metadata['title'] = title
-                metadata['title'] = ''.join((c if c.isascii() else '_'
-                                             for c in metadata['title']))
-                i = add_empty_lines(i)
+        body.append('</div>')
+        return i
+    def add_blockquote(i: int) -> int:
+        add(doc[i][1:], tag='blockquote')
+        return i
+    def add_list(i: int) -> int:
+        body.append('<ul>')
+        while i < num_lines and (line := doc[i]).startswith('* '):
+            add(line[2:], tag='li')
+            i += 1
+        body.append('</ul>')
+        return i-1
+    def add_link(i: int) -> int:
+        link, *label = doc[i][2:].lstrip().split(maxsplit=1)
+        label = label[0] if label else ''
+        if 'url' not in metadata and link.startswith('//'):
+            link = 'gemini:' + link
+            doc[i] = f'=> {link}{"  " if label else ""}{label}'
+        scheme, link_host = link_scheme_and_host(link)
+        if 'url' in metadata and not scheme:
+            base = metadata['url']
+            if base.startswith('gemini://'):
+                # Work around missing IANA registration of gemini://
+                link = 'gemini:' + urljoin(base[7:], link)
             else:
-                add(doc[i][2:], tag='h1')
-                i = add_empty_lines(i)
-            body.append('</div>')
-        elif doc[i].startswith('>'):
-            add(doc[i][1:], tag='blockquote')
-        elif doc[i].startswith('* '):
-            body.append('<ul>')
-            while i < len(doc) and doc[i].startswith('* '):
-                add(doc[i][2:], tag='li')
-                i += 1
-            i -= 1; body.append('</ul>')
-        elif doc[i].startswith('=>'):
-            link, *label = doc[i][2:].lstrip().split(maxsplit=1)
-            label = label[0] if label else ''
-            if 'url' not in metadata and link.startswith('//'):
-                link = 'gemini:' + link
-                doc[i] = f'=> {link}{"  " if label else ""}{label}'
-            scheme, *_= urlparse(link)
-            if 'url' in metadata and not scheme:
-                base = metadata['url']
-                if base.startswith('gemini://'):
-                    # Work around missing IANA registration of gemini://
-                    link = 'gemini:' + urljoin(base[7:], link)
-                else:
-                    link = urljoin(metadata['url'], link)
-                scheme, *_= urlparse(link)
-                doc[i] = f'=> {link}{"  " if label else ""}{label}'
-            css_class = scheme
-            if is_site_relative(link):
-                css_class += (' ' if css_class else '') + '_internal'
-            if not label:
-                label = html_escape(link)
-                css_class += (' ' if css_class else '') + '_nolabel'
-            body.append(f'<a href="{link}" class="{css_class}"><p>'
-                        f'<span class="label">{html_escape(label)}</span> '
-                        f'<br /><span class="url">{html_escape(link)}</span>'
-                         '</p></a>')
-        elif not doc[i].strip():
-            body.append('<br />')
+                link = urljoin(metadata['url'], link)
+            scheme, link_host = link_scheme_and_host(link)
+            doc[i] = f'=> {link}{"  " if label else ""}{label}'
+        css_class = scheme
+        if link_host == site_host:
+            css_class += (' ' if css_class else '') + '_internal'
+        if not label:
+            label = link
+            css_class += (' ' if css_class else '') + '_nolabel'
+        # The link is also used as an attribute value, so quotes need to
+        # be escaped as well
+        link, label = html_escape(link), html_escape(label, quote=False)
+        body.append(f'<a href="{link}" class="{css_class}"><p>'
+                    f'<span class="label">{label}</span> '
+                    f'<br /><span class="url">{link}</span></p></a>')
+        return i
+    handlers = {
+        '```': add_preformatted, '###': add_h3, '##': add_h2, '#': add_h1,
+        '>': add_blockquote, '* ': add_list, '=>': add_link,
+    }
+    doc = doc.splitlines(); num_lines = len(doc); i = 0
+    while i < num_lines:
+        line = doc[i]
+        if line[:1] in _gemini_line_starts \
+                and (m := _gemini_line_re.match(line)):
+            i = handlers[m.group()](i)
+        elif not line.strip():
+            i = add_empty_lines(i-1)
         else:
-            add(doc[i])
+            i = add_paragraphs(i)
         i += 1
     # Try to automatically extract author and date from url if they are
     # missing from metadata
     if 'url' in metadata and metadata['url'] and \
                 ('author' not in metadata or 'date' not in metadata):
-        _scheme, _netloc, path, *_ = urlparse(metadata['url'])
-        if 'author' not in metadata and path.startswith('/~'):
-            metadata['author'] = path[2:].split('/')[0]
+        if 'author' not in metadata and site_path.startswith('/~'):
+            metadata['author'] = site_path[2:].split('/')[0]
         if 'date' not in metadata:
-            possible_date = re.match(
-                r'^([0-9]{4})([-/_])?([0-9]{2})\2([0-9]{2})([^0-9].*)$',
-                path.split('/')[-1]
-            )
+            possible_date = _filename_date_re.match(site_path.split('/')[-1])
             if possible_date:
                 yyyy, _sep, mm, dd, _ = possible_date.groups()
                 metadata['date'] = f'{yyyy}-{mm}-{dd}'
-    colophon = ''
+    colophon = list()
     if metadata.get('author'):
-        colophon += '<author>{}</author>' \
-                                    .format(html_escape(metadata['author']))
+        colophon.append(f'<author>{html_escape(metadata["author"])}</author>')
     if metadata.get('date'):
-        if colophon: colophon += '<datesep>, </datesep>'
-        colophon += '<date>{}</date>'.format(html_escape(metadata['date']))
+        if colophon: colophon.append('<datesep>, </datesep>')
+        colophon.append(f'<date>{html_escape(metadata["date"])}</date>')
     if metadata.get('url'):
-        if colophon: colophon += '<urlsep><br /></urlsep>'
-        colophon += '<url><a href={}>{}</a></url>' \
-                    .format(metadata['url'], html_escape(metadata['url']))
+        if colophon: colophon.append('<urlsep><br /></urlsep>')
+        url = html_escape(metadata['url'])
+        colophon.append(f'<url><a href="{url}">{url}</a></url>')
+    colophon = ''.join(colophon)
     gemini = '\n'.join(doc)
-    html = ('<html><head>\n'
-           f'<colophon>{colophon}</colophon>\n'
-            '</head><body>\n'
-            ''+'\n'.join(body)+'\n'
-            '</body></html>')
+    html = '\n'.join(['<html><head>',
+                      f'<colophon>{colophon}</colophon>',
+                      '</head><body>', *body, '</body></html>'])
     return gemini, html
 
 _default_css = """
@@ -814,15 +1003,32 @@ div.headingcontext {
 }
 """.lstrip()
 
+_compiled_css = dict()
+def compile_css(css: str):
+    """
+    Returns a weasyprint CSS object for the stylesheet given as a string.
+    Compiled stylesheets are cached for the lifetime of the process, so
+    the same stylesheet is only ever parsed once.
+    """
+    if css not in _compiled_css:
+        from weasyprint import CSS
+        _compiled_css[css] = CSS(string=css)
+    return _compiled_css[css]
+
 
 _cli_help = """
-Usage: gemdoc [OPTION]... <GEMINI-URL|INPUT-FILE>
+Usage: gemdoc [OPTION]... <GEMINI-URL|INPUT-FILE>...
+
+Multiple inputs may be given to convert them one after the other in a
+single run. Remote inputs are then fetched concurrently. Processing stops
+at the first input that cannot be converted.
 
 Options
   -o FILE, --output=FILE    Write output to FILE. To print output to stdout,
                             specify a single dash '-' as the output filename.
                             If no output file is specified, the filename will
                             be set automatically based on the source URL.
+                            This option can only be used with a single input.
   -i, --in-place            Modify the input file in place. Or more
                             specifically, replace the input file with the
                             resulting polyglot file. If the input file is
@@ -840,6 +1046,13 @@ Options
                             more than one key. If the input is already in
                             polyglot format, existing pdf metadata will be
                             preserved.
+  -j N, --jobs=N            Convert up to N inputs in parallel, using one
+                            process per job. This only has an effect if
+                            multiple inputs are given. Defaults to 1.
+  --batch FILE              Read additional inputs from FILE, one url or
+                            filename per line. To read the list of inputs
+                            from stdin, specify a single dash '-' as FILE.
+                            This option may be passed multiple times.
   --css FILE                Use the specified css file to style the document.
                             This option may be passed multiple times to use
                             multiple stylesheets. If this option is supplied,
@@ -849,11 +1062,27 @@ Options
   -h, --help                Print this help message and exit.
 """.lstrip()
 
+_hostname_like_re = re.compile(r'^(//)?[^/\.]+\.[^/\.]+')
+_file_extension_re = re.compile(r'[^\.]\.[^\.]+$')
+_inner_dot_re = re.compile(r'[^\.]\.[^\.]')
+_metadata_sep_re = re.compile(r'[=:]')
+_pdf_end_keyword_re = re.compile(r'end(?:stream|obj)')
+
 if __name__ == "__main__":
-    opts, args = getopt(sys.argv[1:], 'ho:M:i',
-                        ['help', 'output=', 'metadata=', 'css=',
-                         'print-default-css', 'in-place', 'no-convert'])
-    output = None; metadata = dict(); input_type = None
+    # Only the command line interface needs these, so they are not
+    # imported when gemdoc is used as a module
+    import tempfile
+    from mimetypes import guess_extension
+    from getopt import gnu_getopt as getopt
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    from multiprocessing import get_context
+    from itertools import repeat
+
+    opts, args = getopt(sys.argv[1:], 'ho:M:ij:',
+                        ['help', 'output=', 'metadata=', 'css=', 'jobs=',
+                         'batch=', 'print-default-css', 'in-place',
+                         'no-convert'])
+    output = None; metadata = dict(); jobs = 1; batch_files = list()
     in_place = False; o_flag = False; no_convert = False
     print_default_css = False; stylesheets = list()
     for k, v in opts:
@@ -865,186 +1094,350 @@ if __name__ == "__main__":
             in_place = True
         elif k == '--no-convert':
             no_convert = True
+        elif k in ['-j', '--jobs']:
+            if not v.isdecimal() or int(v) < 1:
+                err(f'Invalid number of jobs \'{v}\'. The -j option expects '
+                     'a positive integer.')
+            jobs = int(v)
         elif k in ['-M', '--metadata']:
-            m_key, m_value = v.split('=', maxsplit=1) if '=' in v \
-                             else v.split(':', maxsplit=1) if ':' in v \
-                             else (v, '')
+            m_key, m_value, *_ = _metadata_sep_re.split(v, maxsplit=1)+['']
             m_key, m_value = m_key.strip(), m_value.strip()
             if m_key == 'uri': m_key = 'url'
             metadata[m_key] = m_value
         elif k == '--css':
             stylesheets.append(v)
+        elif k == '--batch':
+            batch_files.append(v)
         elif k == '--print-default-css':
             if args:
                 err('The --print-default-css option cannot be combined '
                     'with positional arguments')
             print_default_css = True
+    if batch_files and print_default_css:
+        err('The --print-default-css option cannot be combined with --batch')
+    if batch_files.count('-') > 1 or '-' in batch_files and '-' in args:
+        err('Stdin can only be read once, either as a batch file or as an '
+            'input file')
+    for batch_file in batch_files:
+        try:
+            if batch_file == '-':
+                batch = sys.stdin.read()
+            else:
+                with open(batch_file) as f:
+                    batch = f.read()
+        except Exception as e:
+            err(f'Unable to read batch file. {e}')
+        args.extend(line.strip() for line in batch.splitlines()
+                                 if line.strip())
+
+    def refuse_existing_output(output: str):
+        err(f'The output file \'{output}\' already exists. This file will '
+            f'not be replaced. To replace \'{output}\', use the -o flag to '
+             'explicitly specify the filename.')
 
-    def write_output(doc: Union[str,bytes]):
+    def write_output(doc: Union[str,bytes], output: str, exclusive=False):
+        """
+        If exclusive is set, an existing output file is never replaced.
+        """
+        if isinstance(doc, str):
+            binary = False
+        elif isinstance(doc, (bytes, bytearray)):
+            binary = True
+        else:
+            raise Exception(f'Invalid type {type(doc)}')
         if output == '-':
-            if type(doc) == str:
-                sys.stdout.write(doc)
-            elif type(doc) == bytes:
-                sys.stdout.buffer.write(doc)
-            else:
-                raise Exception(f'Invalid type {type(doc)}')
+            (sys.stdout.buffer if binary else sys.stdout).write(doc)
         else:
-            if type(doc) == str:
-                with open(output, 'w') as f:
-                    f.write(doc)
-            elif type(doc) == bytes:
-                with open(output, 'wb') as f:
-                    f.write(doc)
-            else:
-                raise Exception(f'Invalid type {type(doc)}')
+            try:
+                f = open(output, ('x' if exclusive else 'w')
+                                 + ('b' if binary else ''))
+            except FileExistsError:
+                refuse_existing_output(output)
+            with f:
+                f.write(doc)
 
-    if print_default_css:
-        if output == None: output = '-'
-        write_output(_default_css); exit(0)
-    elif len(args) != 1:
-        err('Gemdoc takes exactly one positional argument but got '
-           f'{len(args)}. To force reading data from stdin, specify '
-            'a single dash \'-\' as the input file.')
-    elif args[0] == '-':
-        doc = sys.stdin.read(); input_type = 'local'
-    elif not args[0].startswith('gemini://') and os.path.exists(args[0]):
-        with open(args[0]) as f:
-            doc = f.read(); input_type = 'local'
-    elif args[0].startswith('gemini://') or \
-         re.match(r'^(//)?[^/\.]+\.[^/\.]+', args[0]):
-        if args[0].startswith('//'): args[0] = 'gemini:'+args[0]
-        if not args[0].startswith('gemini://'): args[0] = 'gemini://'+args[0]
-        url, mime_type, doc = retrieve_url(args[0]); input_type = 'remote'
-        if 'url' not in metadata: metadata['url'] = url
-    else:
-        err(f"'{args[0]}' does not seem to be a gemini url and there is "
-             'no such file on the local system either.')
+    def preload_weasyprint():
+        import weasyprint
+        compile_css(_minimal_css)
+        if not stylesheets: compile_css(_default_css)
 
-    if no_convert and input_type == 'local':
-        err('The --no-convert option can only be used with remote inputs')
-    elif not o_flag and not in_place:
-        if input_type == 'local':
-            err('Either -i or -o must be specified for local inputs')
+    renderer = dict()
+    def start_preload():
+        if renderer: return
+        # Importing weasyprint takes a noticeable amount of time, so
+        # do it in the background while waiting for the server.
+        executor = ThreadPoolExecutor(max_workers=1)
+        renderer['preload'] = executor.submit(preload_weasyprint)
+        executor.shutdown(wait=False)
+    def load_renderer() -> dict:
+        """
+        Import weasyprint and set up everything that can be shared between
+        the conversion of multiple documents. This only happens once, when
+        the first document is about to be rendered.
+        """
+        if 'html' in renderer: return renderer
+        if 'preload' in renderer: renderer.pop('preload').result()
+        from weasyprint import HTML, __version__ as weasyprint_version
+        try:
+            from packaging.version import parse as parse_version
+        except ImportError:
+            from pkg_resources import parse_version
+        try:
+            from weasyprint.text.fonts import FontConfiguration
+        except ImportError:
+            from weasyprint.fonts import FontConfiguration
+        css = [compile_css(_minimal_css)]
+        try:
+            for s in stylesheets:
+                with open(s) as f:
+                    css.append(compile_css(f.read()))
+        except Exception as e:
+            err(f'Unable to read css file. {e}')
+        if not stylesheets: css.append(compile_css(_default_css))
+
+        extra_weasyprint_opts = {}
+        extra_gemdocpdf_opts = {}
+        weasyprint_version = parse_version(weasyprint_version)
+        if weasyprint_version < parse_version('56.0'):
+            warn('The current version of weasyprint (version '
+                f'{weasyprint_version}) does not include support for '
+                 'generating PDF/A documents. To have gemdoc generate a file '
+                 'that conforms to PDF/A requirements, make sure to use '
+                 'weasyprint version 56.0 or above.')
+        elif weasyprint_version < parse_version('59.0b1'):
+            if weasyprint_version < parse_version('57.2'):
+                warn('The current version of weasyprint (version '
+                    f'{weasyprint_version}) is known to generate pdfs that do '
+                     'not fully conform to the PDF/A-3B specification. To '
+                     'have gemdoc generate a file that fully conforms to '
+                     'PDF/A-3B requirements, make sure to use weasyprint '
+                     'version 58 or above.')
+            extra_weasyprint_opts['version'] = '1.7'
+            extra_weasyprint_opts['variant'] = 'pdf/a-3b'
         else:
-            pass  # The filename will be determined later on based on the URL
-    elif in_place:
-        if o_flag:
-            err('The -o and -i flags are mutually exclusive')
-        elif input_type != 'local':
-            err('The -i flag can only be used for local inputs')
-        elif args[0] == '-':
-            err('The -i flag can not be used to process stdin. To use gemdoc'
-                'as a unix filter, use \'-o-\' instead.')
-        elif not os.path.isfile(args[0]) or os.path.islink(args[0]):
-            err(f'Cannot modify \'{args[0]}\' in place: Not a regular file')
+            extra_weasyprint_opts['pdf_version'] = '1.7'
+            extra_weasyprint_opts['pdf_variant'] = 'pdf/a-3b'
+            extra_weasyprint_opts['uncompressed_pdf'] = True
+            extra_gemdocpdf_opts['flateencode_streams'] = True
+
+        renderer['font_configuration'] = FontConfiguration
+        renderer['html'] = HTML
+        renderer['css'] = css
+        renderer['weasyprint_opts'] = extra_weasyprint_opts
+        renderer['gemdocpdf_opts'] = extra_gemdocpdf_opts
+        return renderer
+
+    def is_remote(arg: str) -> bool:
+        if arg == '-':
+            return False
+        elif not arg.startswith('gemini://') and os.path.exists(arg):
+            return False
         else:
-            output = tempfile.mktemp(
-                dir = os.path.dirname(args[0]),
-                prefix = os.path.basename(args[0])+'.',
-            )
-
-    from weasyprint import HTML, CSS, __version__ as weasyprint_version
-    css = [CSS(string=_minimal_css)]
-    try:
-        for s in stylesheets:
-            with open(s) as f:
-                css.append(CSS(string=f.read()))
-    except Exception as e:
-        err(f'Unable to read css file. {e}')
-    if not stylesheets: css.append(CSS(string=_default_css))
-
-    if input_type == 'local':
-        if is_gemdoc_pdf(doc):
-            doc, pdf_metadata = extract_gemini_part(doc)
-            for k, v in pdf_metadata.items():
-                if k not in metadata: metadata[k] = v
-
-    elif input_type == 'remote':
-        if not o_flag:
-            _, _, input_url_path, *_ = urlparse(args[0])
-            output = os.path.basename(input_url_path.rstrip('/')) \
-                                     .lstrip('.~/')
-            if mime_type == 'text/gemini' and output.endswith('.gmi'):
-                if not no_convert: output = output[:-4]+'.pdf'
-            if not re.search(r'[^\.]\.[^\.]+$', output):
-                if mime_type == 'text/gemini':
-                    output += '.gmi' if no_convert else '.pdf'
-                else:
-                    output += guess_extension(mime_type, strict=False) or ''
-            if os.path.exists(output):
-                err(f'The output file \'{output}\' already exists. This file '
-                    f'will not be replaced. To replace \'{output}\', use the '
-                     '-o flag to explicitly specify the filename.')
-        if no_convert:
-            write_output(doc)
-            exit(0)
-        elif mime_type.lower() == 'text/gemini' \
-                        and doc.lstrip().startswith('%PDF-') \
-          or mime_type.lower() == 'application/pdf' \
-                        and doc.lstrip().startswith(b'%PDF-'):
-            write_output(doc)
-            exit(0)
-        elif mime_type.lower() == 'text/gemini':
-            pass
+            return arg.startswith('gemini://') or \
+                   bool(_hostname_like_re.match(arg))
+
+    def read_input(arg: str) -> tuple:
+        """
+        Returns a tuple of type (arg, input_type, mime_type, charset, url,
+        doc), where arg is the possibly normalized input argument and doc
+        is the undecoded content. The mime_type, charset and url are only
+        set for remote inputs.
+        """
+        mime_type = charset = url = None
+        if arg == '-':
+            doc = sys.stdin.buffer.read(); input_type = 'local'
+        elif not arg.startswith('gemini://') and os.path.exists(arg):
+            # Unbuffered, the whole file is read with a single read sized
+            # by fstat, and there is no isatty check for line buffering
+            with open(arg, 'rb', buffering=0) as f:
+                doc = f.readall(); input_type = 'local'
+        # The branch above has already ruled out local files, so this
+        # does not need to go through is_remote and check the path again
+        elif (has_scheme := arg.startswith('gemini://')) \
+                or (hostname := _hostname_like_re.match(arg)):
+            if not has_scheme:
+                arg = ('gemini:' if hostname.group(1) else 'gemini://')+arg
+            if not no_convert: start_preload()
+            url, mime_type, charset, doc = retrieve_url(arg)
+            input_type = 'remote'
         else:
-            warn(f'Writing non pdf file to {output}. The file\'s mime type '
-                 f'was reported to be \'{mime_type}\'.')
-            write_output(doc)
-            exit(0)
-
-    gemini_filename = 'source.gmi'
-    if 'url' in metadata:
-        _scheme, _netloc, path, *_ = urlparse(metadata['url'])
-        if path:
-            gemini_filename = path.split('/')[-1]
-            if '%' in gemini_filename:
-                gemini_filename = urlunquote(gemini_filename)
-            if not re.search(r'[^\.]\.[^\.]', gemini_filename):
-                gemini_filename = gemini_filename+'.gmi'
-
-    if 'endstream' in doc:
-        doc = doc.replace('endstream', 'e\u200bndstream')
-        warn('Warning: Occurrences of the \'endstream\' keyword have been '
-             'escaped by inserting a zero width space after the first '
-             'character')
-    if 'endobj' in doc:
-        doc = doc.replace('endobj', 'e\u200bndobj')
-        warn('Warning: Occurrences of the \'endobj\' keyword have been '
-             'escaped by inserting a zero width space after the first '
-             'character')
-
-    gemini, html = parse_gemini(doc, metadata)
-    html = HTML(string=html)
-    pdf = BytesIO()
-    extra_weasyprint_opts = {}
-    extra_gemdocpdf_opts = {}
-    weasyprint_version = parse_version(weasyprint_version)
-    if weasyprint_version < parse_version('56.0'):
-        warn('The current version of weasyprint (version '
-            f'{weasyprint_version}) does not include support for generating '
-             'PDF/A documents. To have gemdoc generate a file that conforms '
-             'to PDF/A requirements, make sure to use weasyprint version '
-             '56.0 or above.')
-    elif weasyprint_version < parse_version('59.0b1'):
-        if weasyprint_version < parse_version('57.2'):
-            warn('The current version of weasyprint (version '
-                f'{weasyprint_version}) is known to generate pdfs that do '
-                 'not fully conform to the PDF/A-3B specification. To have '
-                 'gemdoc generate a file that fully conforms to PDF/A-3B '
-                 'requirements, make sure to use weasyprint version 58 or '
-                 'above.')
-        extra_weasyprint_opts['version'] = '1.7'
-        extra_weasyprint_opts['variant'] = 'pdf/a-3b'
+            err(f"'{arg}' does not seem to be a gemini url and there is "
+                 'no such file on the local system either.')
+        return arg, input_type, mime_type, charset, url, doc
+
+    def convert(source: tuple, output: str, metadata: dict):
+        arg, input_type, mime_type, charset, url, doc = source
+        if input_type == 'remote' and 'url' not in metadata:
+            metadata['url'] = url
+        # Output filenames derived from the url must not replace existing
+        # files. The check below only fails early; opening the output
+        # exclusively is what guarantees it, also with parallel jobs.
+        auto_output = input_type == 'remote' and not o_flag
+
+        if no_convert and input_type == 'local':
+            err('The --no-convert option can only be used with remote inputs')
+        elif not o_flag and not in_place:
+            if input_type == 'local':
+                err('Either -i or -o must be specified for local inputs')
+            else:
+                pass  # The filename will be determined below based on the URL
+        elif in_place:
+            if o_flag:
+                err('The -o and -i flags are mutually exclusive')
+            elif input_type != 'local':
+                err('The -i flag can only be used for local inputs')
+            elif arg == '-':
+                err('The -i flag can not be used to process stdin. To use '
+                    'gemdoc as a unix filter, use \'-o-\' instead.')
+            elif not os.path.isfile(arg) or os.path.islink(arg):
+                err(f'Cannot modify \'{arg}\' in place: Not a regular file')
+            else:
+                output = arg    # Replaced through a temporary file below
+
+        if input_type == 'local':
+            if is_gemdoc_pdf(doc):
+                doc, pdf_metadata = extract_gemini_part(doc)
+                # Metadata given on the command line takes precedence
+                metadata = pdf_metadata | metadata
+            else:
+                doc = doc.decode('utf-8')
+
+        elif input_type == 'remote':
+            if not o_flag:
+                _, _, input_url_path, *_ = urlparse(arg)
+                output = os.path.basename(input_url_path.rstrip('/')) \
+                                         .lstrip('.~/')
+                if mime_type == 'text/gemini' and output.endswith('.gmi'):
+                    if not no_convert: output = output[:-4]+'.pdf'
+                if not _file_extension_re.search(output):
+                    if mime_type == 'text/gemini':
+                        output += '.gmi' if no_convert else '.pdf'
+                    else:
+                        output += guess_extension(mime_type, strict=False) \
+                                                                        or ''
+                if os.path.exists(output): refuse_existing_output(output)
+            if mime_type in ['text/gemini', 'application/pdf'] \
+                            and not no_convert and _pdf_header_re.match(doc):
+                # Polyglots and pdf files are saved without decoding them
+                write_output(doc, output, exclusive=auto_output)
+                return
+            if mime_type.startswith('text/'): doc = doc.decode(charset)
+            if no_convert:
+                write_output(doc, output, exclusive=auto_output)
+                return
+            elif mime_type == 'text/gemini':
+                pass
+            else:
+                warn(f'Writing non pdf file to {output}. The file\'s mime '
+                     f'type was reported to be \'{mime_type}\'.')
+                write_output(doc, output, exclusive=auto_output)
+                return
+
+        renderer = load_renderer()
+        # The font configuration sets up fontconfig and pango state, which
+        # may involve GLib worker threads. It is only created in the
+        # process that renders, so that -j never forks with such threads.
+        if 'font_config' not in renderer['weasyprint_opts']:
+            renderer['weasyprint_opts']['font_config'] = \
+                                        renderer['font_configuration']()
+
+        gemini_filename = 'source.gmi'
+        if 'url' in metadata:
+            _scheme, _netloc, path, *_ = urlparse(metadata['url'])
+            if path:
+                gemini_filename = path.split('/')[-1]
+                if '%' in gemini_filename:
+                    gemini_filename = urlunquote(gemini_filename)
+                # Only names with a dot away from the edges can have an
+                # inner dot, so the regex is not needed for all others
+                if '.' not in gemini_filename[1:-1] \
+                        or not _inner_dot_re.search(gemini_filename):
+                    gemini_filename = gemini_filename+'.gmi'
+
+        # Escape both keywords in a single pass over the document
+        escaped = set()
+        def escape_keyword(m) -> str:
+            escaped.add(m.group()); return 'e\u200b'+m.group()[1:]
+        doc = _pdf_end_keyword_re.sub(escape_keyword, doc)
+        if 'endstream' in escaped:
+            warn('Warning: Occurrences of the \'endstream\' keyword have '
+                 'been escaped by inserting a zero width space after the '
+                 'first character')
+        if 'endobj' in escaped:
+            warn('Warning: Occurrences of the \'endobj\' keyword have been '
+                 'escaped by inserting a zero width space after the first '
+                 'character')
+
+        gemini, html = parse_gemini(doc, metadata)
+        html = renderer['html'](string=html)
+        # Without a target, write_pdf returns the rendered document as bytes
+        pdf = html.write_pdf(stylesheets=renderer['css'],
+                             **renderer['weasyprint_opts'])
+        polyglot = GemdocPDF(gemini, pdf, gemini_filename=gemini_filename,
+                             **renderer['gemdocpdf_opts'])
+        polyglot.set_metadata(metadata)
+        if in_place:
+            # mkstemp creates the temporary file exclusively, so there is
+            # no window in which another file could take its name, and
+            # os.replace swaps it in for the input in a single step.
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(arg),
+                                       prefix=os.path.basename(arg)+'.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    polyglot.serialize_into(f)
+                os.chmod(tmp, os.stat(arg).st_mode & 0o7777)
+                os.replace(tmp, arg)
+            except BaseException:
+                os.unlink(tmp); raise
+        elif output == '-':
+            polyglot.serialize_into(sys.stdout.buffer)
+        else:
+            try:
+                f = open(output, 'xb' if auto_output else 'wb')
+            except FileExistsError:
+                refuse_existing_output(output)
+            with f:
+                polyglot.serialize_into(f)
+
+    if print_default_css:
+        if output == None: output = '-'
+        write_output(_default_css, output); exit(0)
+    elif not args:
+        err('Gemdoc takes at least one positional argument but got none. '
+            'To force reading data from stdin, specify a single dash \'-\' '
+            'as the input file.')
+    elif len(args) > 1 and o_flag:
+        err('The -o flag can only be used with a single input, but got '
+           f'{len(args)} inputs.')
+    if jobs > 1 and len(args) > 1:
+        def read_and_convert(arg: str, output: str, metadata: dict):
+            convert(read_input(arg), output, metadata)
+        # Load weasyprint before forking, so that the import, the compiled
+        # stylesheets and any version warnings are shared by all workers.
+        # Each worker creates its own font configuration when it renders.
+        if not no_convert: load_renderer()
+        executor = ProcessPoolExecutor(max_workers=min(jobs, len(args)),
+                                       mp_context=get_context('fork'))
+        try:
+            for _ in executor.map(read_and_convert, args, repeat(output),
+                                  (dict(metadata) for _ in args)):
+                pass
+        finally:
+            executor.shutdown(cancel_futures=True)
+    elif len(args) > 1:
+        # Fetch all remote inputs concurrently. Local inputs are still
+        # read, and everything is still converted, one input at a time in
+        # the order given on the command line.
+        if not no_convert: start_preload()
+        fetcher = ThreadPoolExecutor(max_workers=min(8, len(args)))
+        try:
+            sources = [fetcher.submit(read_input, arg) if is_remote(arg)
+                       else arg for arg in args]
+            for source in sources:
+                source = read_input(source) if isinstance(source, str) \
+                         else source.result()
+                convert(source, output, dict(metadata))
+        finally:
+            fetcher.shutdown(cancel_futures=True)
     else:
-        extra_weasyprint_opts['pdf_version'] = '1.7'
-        extra_weasyprint_opts['pdf_variant'] = 'pdf/a-3b'
-        extra_weasyprint_opts['uncompressed_pdf'] = True
-        extra_gemdocpdf_opts['flateencode_streams'] = True
-
-    html.write_pdf(pdf, stylesheets=css, **extra_weasyprint_opts)
-    pdf.seek(0); polyglot = GemdocPDF(gemini, pdf.read(),
-                                      gemini_filename=gemini_filename,
-                                      **extra_gemdocpdf_opts)
-    polyglot.set_metadata(metadata)
-    write_output(polyglot.serialize())
-    if in_place: os.rename(output, args[0])
+        convert(read_input(args[0]), output, dict(metadata))